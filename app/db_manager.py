@@ -1,6 +1,7 @@
+import asyncio
 import asyncpg
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 import os
 from dotenv import load_dotenv
@@ -15,12 +16,151 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv('.env-local' if os.path.exists('.env-local') else '.env')
 
+# Ticket queries, formatted once per monthly table. Keeping the text stable
+# lets asyncpg reuse its per-connection prepared statement cache.
+TICKET_QUERIES = {
+    'get_user_tickets': '''
+        SELECT ticket_number, is_valid
+        FROM {table}
+        WHERE username = $1
+        ORDER BY ticket_number
+    ''',
+    # Full syncs take this exclusively and per-user syncs take it shared, so
+    # full syncs run one at a time. Unlike a table lock it leaves autovacuum
+    # alone.
+    'lock_sync': '''
+        SELECT pg_advisory_xact_lock(hashtext('{table}'))
+    ''',
+    'lock_sync_shared': '''
+        SELECT pg_advisory_xact_lock_shared(hashtext('{table}'))
+    ''',
+    # Serialize syncs of the same user, including one who has no rows to lock yet
+    'lock_user': '''
+        SELECT pg_advisory_xact_lock(hashtext('{table}'), hashtext($1))
+    ''',
+    'lock_user_tickets': '''
+        SELECT ticket_number, is_valid
+        FROM {table}
+        WHERE username = $1
+        ORDER BY ticket_number
+        FOR UPDATE
+    ''',
+    # Build the {"tickets": {username: [numbers]}} payload in Postgres
+    'all_valid_tickets_json': '''
+        SELECT json_build_object(
+            'tickets',
+            COALESCE(json_object_agg(username, ticket_numbers ORDER BY username), '{{}}'::json)
+        )
+        FROM (
+            SELECT username, array_agg(ticket_number ORDER BY ticket_number) AS ticket_numbers
+            FROM {table}
+            WHERE is_valid = TRUE
+            GROUP BY username
+        ) AS valid_tickets
+    ''',
+    'insert_tickets': '''
+        INSERT INTO {table} (username)
+        SELECT $1 FROM generate_series(1, $2)
+    ''',
+    'invalidate_lowest_ticket': '''
+        UPDATE {table}
+        SET is_valid = FALSE
+        WHERE ctid = (
+            SELECT ctid
+            FROM {table}
+            WHERE username = $1
+            AND is_valid = TRUE
+            ORDER BY ticket_number
+            LIMIT 1
+        )
+    ''',
+    'invalidate_user_tickets': '''
+        UPDATE {table}
+        SET is_valid = FALSE
+        WHERE username = $1 AND ticket_number = ANY($2::bigint[])
+    ''',
+    # Invalidate every valid ticket beyond what each user is entitled to,
+    # lowest numbers first. Users missing from the entries get nothing.
+    'sync_invalidate': '''
+        WITH req AS (
+            SELECT * FROM unnest($1::text[], $2::int[]) AS r(username, need)
+        ),
+        ranked AS (
+            SELECT ticket_number, username,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY username ORDER BY ticket_number DESC
+                   ) AS keep_rank
+            FROM {table}
+            WHERE is_valid = TRUE
+        )
+        UPDATE {table} AS t
+        SET is_valid = FALSE
+        FROM ranked
+        LEFT JOIN req ON req.username = ranked.username
+        WHERE t.ticket_number = ranked.ticket_number
+        AND ranked.keep_rank > COALESCE(req.need, 0)
+    ''',
+    # Add the missing tickets for every user in one insert, numbered in the
+    # order the entries were given
+    'sync_add': '''
+        WITH req AS (
+            SELECT *
+            FROM unnest($1::text[], $2::int[]) WITH ORDINALITY AS r(username, need, position)
+        ),
+        cur AS (
+            SELECT username, COUNT(*) AS have
+            FROM {table}
+            WHERE is_valid = TRUE
+            GROUP BY username
+        ),
+        missing AS (
+            SELECT req.username, req.position, req.need - COALESCE(cur.have, 0) AS shortfall
+            FROM req
+            LEFT JOIN cur ON cur.username = req.username
+            WHERE req.need > COALESCE(cur.have, 0)
+        )
+        INSERT INTO {table} (username)
+        SELECT missing.username
+        FROM missing
+        CROSS JOIN generate_series(1, missing.shortfall)
+        ORDER BY missing.position
+    ''',
+}
+
 class DatabaseManager:
     def __init__(self):
         self.pool: Optional[asyncpg.Pool] = None
-        self.current_month = datetime.now().strftime("%Y%m")
-        self.table_name = f"tickets_{self.current_month}"
         self.schema = os.getenv('DB_SCHEMA', 'public')
+        self.current_month: Optional[str] = None
+        self._table_name: Optional[str] = None
+        self._queries: Dict[str, str] = {}
+        self._rotate_at: Optional[datetime] = None
+        self._created_table: Optional[str] = None
+        self._table_lock = asyncio.Lock()
+
+    def _rotate_table(self):
+        """Switch to the current month's table once the month boundary has passed"""
+        now = datetime.now()
+        if self._rotate_at is not None and now < self._rotate_at:
+            return
+        self.current_month = now.strftime("%Y%m")
+        self._table_name = f"tickets_{self.current_month}"
+        table = f"{self.schema}.{self._table_name}"
+        self._queries = {name: sql.format(table=table) for name, sql in TICKET_QUERIES.items()}
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        self._rotate_at = (month_start + timedelta(days=32)).replace(day=1)
+
+    @property
+    def table_name(self) -> str:
+        """The current month's tickets table"""
+        self._rotate_table()
+        return self._table_name
+
+    @property
+    def queries(self) -> Dict[str, str]:
+        """The ticket queries resolved against the current month's table"""
+        self._rotate_table()
+        return self._queries
 
     async def init_pool(self):
         """Initialize the database connection pool"""
@@ -30,7 +170,14 @@ class DatabaseManager:
                 port=int(os.getenv('DB_PORT', 5432)),
                 database=os.getenv('DB_NAME', 'giveaway'),
                 user=os.getenv('DB_USER', 'postgres'),
-                password=os.getenv('DB_PASSWORD', 'postgres')
+                password=os.getenv('DB_PASSWORD', 'postgres'),
+                # Size the pool as cores * 2 + 1 and fail fast on stuck queries
+                min_size=int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                max_size=int(os.getenv('DB_POOL_MAX_SIZE', (os.cpu_count() or 1) * 2 + 1)),
+                max_inactive_connection_lifetime=300,
+                command_timeout=float(os.getenv('DB_COMMAND_TIMEOUT', 10)),
+                # Avoid JIT planning overhead on the large array-driven sync queries
+                server_settings={'jit': 'off'}
             )
 
     async def close_pool(self):
@@ -39,8 +186,9 @@ class DatabaseManager:
             await self.pool.close()
             self.pool = None
 
-    async def create_tickets_table(self):
+    async def create_tickets_table(self, table_name: Optional[str] = None):
         """Create the tickets table if it doesn't exist"""
+        table_name = table_name or self.table_name
         async with self.pool.acquire() as conn:
             # Create schema if it doesn't exist
             await conn.execute(f'''
@@ -49,133 +197,126 @@ class DatabaseManager:
             
             # Create table in the specified schema
             await conn.execute(f'''
-                CREATE TABLE IF NOT EXISTS {self.schema}.{self.table_name} (
-                    ticket_number INTEGER PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS {self.schema}.{table_name} (
+                    ticket_number BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
                     username TEXT NOT NULL,
                     is_valid BOOLEAN DEFAULT TRUE,
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
 
-    async def get_next_ticket_number(self) -> int:
-        """Get the next available ticket number"""
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchval(f'''
-                SELECT COALESCE(MAX(ticket_number), 0) + 1
-                FROM {self.schema}.{self.table_name}
+            # Index the per-user lookups
+            await conn.execute(f'''
+                CREATE INDEX IF NOT EXISTS idx_{table_name}_user
+                ON {self.schema}.{table_name} (username, ticket_number)
             ''')
-            return result
+
+            # Tables created before ticket numbers came from an identity
+            # column need one, continuing after the highest existing ticket
+            is_identity = await conn.fetchval('''
+                SELECT is_identity
+                FROM information_schema.columns
+                WHERE table_schema = $1 AND table_name = $2
+                AND column_name = 'ticket_number'
+            ''', self.schema, table_name)
+            if is_identity == 'NO':
+                async with conn.transaction():
+                    await conn.execute(f'''
+                        ALTER TABLE {self.schema}.{table_name}
+                        ALTER COLUMN ticket_number ADD GENERATED BY DEFAULT AS IDENTITY
+                    ''')
+                    await conn.execute(f'''
+                        SELECT setval(
+                            pg_get_serial_sequence('{self.schema}.{table_name}', 'ticket_number'),
+                            COALESCE(MAX(ticket_number), 0) + 1,
+                            false
+                        )
+                        FROM {self.schema}.{table_name}
+                    ''')
+
+        self._created_table = table_name
+
+    async def ensure_tickets_table(self) -> Dict[str, str]:
+        """Create the current month's table if needed and return its queries"""
+        # Callers run a whole operation against the returned queries, so a
+        # month rollover partway through cannot switch tables under them
+        self._rotate_table()
+        table_name, queries = self._table_name, self._queries
+        if self._created_table != table_name:
+            # After a rollover, only one caller creates the new table
+            async with self._table_lock:
+                if self._created_table != table_name:
+                    await self.create_tickets_table(table_name)
+        return queries
 
     async def get_user_tickets(self, username: str) -> List[Tuple[int, bool]]:
         """Get all tickets for a user"""
+        queries = await self.ensure_tickets_table()
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(f'''
-                SELECT ticket_number, is_valid
-                FROM {self.schema}.{self.table_name}
-                WHERE username = $1
-                ORDER BY ticket_number
-            ''', username.lower())
+            rows = await conn.fetch(queries['get_user_tickets'], username.lower())
             return [(row['ticket_number'], row['is_valid']) for row in rows]
 
+    async def get_all_tickets_json(self) -> str:
+        """Get all valid tickets grouped by user, as a JSON document"""
+        queries = await self.ensure_tickets_table()
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(queries['all_valid_tickets_json'])
+
     async def add_tickets(self, username: str, count: int):
         """Add new tickets for a user"""
+        queries = await self.ensure_tickets_table()
         async with self.pool.acquire() as conn:
-            # Get the next ticket number
-            next_ticket = await self.get_next_ticket_number()
-            
-            # Insert new tickets
-            for i in range(count):
-                await conn.execute(f'''
-                    INSERT INTO {self.schema}.{self.table_name} (ticket_number, username)
-                    VALUES ($1, $2)
-                ''', next_ticket + i, username.lower())
+            await conn.execute(queries['insert_tickets'], username.lower(), count)
 
     async def invalidate_ticket(self, username: str):
         """Invalidate the lowest numbered ticket for a user"""
+        queries = await self.ensure_tickets_table()
         async with self.pool.acquire() as conn:
-            await conn.execute(f'''
-                UPDATE {self.schema}.{self.table_name}
-                SET is_valid = FALSE
-                WHERE username = $1
-                AND ticket_number = (
-                    SELECT MIN(ticket_number)
-                    FROM {self.schema}.{self.table_name}
-                    WHERE username = $1
-                    AND is_valid = TRUE
-                )
-            ''', username.lower())
+            await conn.execute(queries['invalidate_lowest_ticket'], username.lower())
 
     async def sync_user_tickets(self, username: str, required_entries: int):
         """Sync a user's tickets to match their required entries"""
+        queries = await self.ensure_tickets_table()
         async with self.pool.acquire() as conn:
-            # Get all tickets for the user, ordered by ticket number
-            rows = await conn.fetch(f'''
-                SELECT ticket_number, is_valid
-                FROM {self.schema}.{self.table_name}
-                WHERE username = $1
-                ORDER BY ticket_number
-            ''', username.lower())
-            
-            current_tickets = [(row['ticket_number'], row['is_valid']) for row in rows]
-            valid_tickets = sum(1 for _, is_valid in current_tickets if is_valid)
-            
-            if valid_tickets > required_entries:
-                # Need to invalidate some tickets, starting with the lowest numbers
-                tickets_to_invalidate = valid_tickets - required_entries
-                for ticket_number, is_valid in current_tickets:
-                    if tickets_to_invalidate <= 0:
-                        break
-                    if is_valid:
-                        await conn.execute(f'''
-                            UPDATE {self.schema}.{self.table_name}
-                            SET is_valid = FALSE
-                            WHERE username = $1 AND ticket_number = $2
-                        ''', username.lower(), ticket_number)
-                        tickets_to_invalidate -= 1
-            
-            elif valid_tickets < required_entries:
-                # Need to add more tickets
-                tickets_to_add = required_entries - valid_tickets
-                next_ticket = await self.get_next_ticket_number()
-                
-                for i in range(tickets_to_add):
-                    await conn.execute(f'''
-                        INSERT INTO {self.schema}.{self.table_name} (ticket_number, username)
-                        VALUES ($1, $2)
-                    ''', next_ticket + i, username.lower())
+            async with conn.transaction():
+                # A lost commit on crash is corrected by the next sync
+                await conn.execute("SET LOCAL synchronous_commit = OFF")
+                await conn.execute(queries['lock_sync_shared'])
+                await conn.execute(queries['lock_user'], username.lower())
 
-    async def sync_all_tickets(self, entries: Dict[str, int]):
-        """Sync all users' tickets to match their required entries"""
-        await self.init_pool()
-        try:
-            await self.create_tickets_table()
-            
-            # First, get all users who have tickets in the database
-            async with self.pool.acquire() as conn:
-                # Get all users with tickets
-                rows = await conn.fetch(f'''
-                    SELECT DISTINCT username
-                    FROM {self.schema}.{self.table_name}
-                    WHERE is_valid = TRUE
-                ''')
-                users_with_tickets = {row['username'] for row in rows}
+                # Lock all tickets for the user, ordered by ticket number
+                rows = await conn.fetch(queries['lock_user_tickets'], username.lower())
                 
-                # Get users who should have tickets (from entries)
-                users_with_entries = set(entries.keys())
+                current_tickets = [(row['ticket_number'], row['is_valid']) for row in rows]
+                valid_tickets = sum(1 for _, is_valid in current_tickets if is_valid)
                 
-                # Find users who have tickets but shouldn't
-                users_to_invalidate = users_with_tickets - users_with_entries
+                if valid_tickets > required_entries:
+                    # Need to invalidate some tickets, starting with the lowest numbers
+                    tickets_to_invalidate = valid_tickets - required_entries
+                    to_invalidate = [
+                        ticket_number for ticket_number, is_valid in current_tickets if is_valid
+                    ][:tickets_to_invalidate]
+                    await conn.execute(
+                        queries['invalidate_user_tickets'], username.lower(), to_invalidate
+                    )
                 
-                # Invalidate all tickets for users who shouldn't have any
-                for username in users_to_invalidate:
-                    await conn.execute(f'''
-                        UPDATE {self.schema}.{self.table_name}
-                        SET is_valid = FALSE
-                        WHERE username = $1
-                    ''', username)
-                
-                # Now sync tickets for users who should have them
-                for username, entry_count in entries.items():
-                    await self.sync_user_tickets(username, entry_count)
-        finally:
-            await self.close_pool() 
\ No newline at end of file
+                elif valid_tickets < required_entries:
+                    # Need to add more tickets
+                    tickets_to_add = required_entries - valid_tickets
+                    await conn.execute(
+                        queries['insert_tickets'], username.lower(), tickets_to_add
+                    )
+
+    async def sync_all_tickets(self, entries: Dict[str, int]):
+        """Sync all users' tickets to match their required entries"""
+        queries = await self.ensure_tickets_table()
+
+        usernames = [username.lower() for username in entries]
+        required = list(entries.values())
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SET LOCAL synchronous_commit = OFF")
+                await conn.execute(queries['lock_sync'])
+                await conn.execute(queries['sync_invalidate'], usernames, required)
+                await conn.execute(queries['sync_add'], usernames, required)
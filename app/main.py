@@ -1,4 +1,5 @@
 from fastapi import FastAPI, Response, HTTPException
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 import uvicorn
@@ -21,28 +22,35 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv('.env-local' if os.path.exists('.env-local') else '.env')
 
-# Create a global collector instance
+# Create global database manager and collector instances
+db_manager = DatabaseManager()
 collector = None
+polling_task: Optional[asyncio.Task] = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global collector
-    collector = StatsCollector()
-    asyncio.create_task(collector.start_polling())
-    db_manager = DatabaseManager()
+    global collector, polling_task
     try:
         await db_manager.init_pool()
         await db_manager.create_tickets_table()
     except Exception as e:
         logger.error(f"Error initializing database: {str(e)}")
         raise e
-    finally:
-        await db_manager.close_pool()
+    collector = StatsCollector(db_manager)
+    await collector.init_session()
+    polling_task = asyncio.create_task(collector.start_polling())
     yield
-    # Shutdown
+    # Shutdown: stop polling before closing what it uses
+    if polling_task:
+        polling_task.cancel()
+        try:
+            await polling_task
+        except asyncio.CancelledError:
+            pass
     if collector:
         await collector.close_session()
+    await db_manager.close_pool()
 
 app = FastAPI(
     title="Health API",
@@ -50,6 +58,7 @@ app = FastAPI(
     version="1.0.0",
     docs_url=None,  # Disable Swagger UI in production
     redoc_url=None,  # Disable ReDoc in production
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -82,9 +91,7 @@ async def health_check(response: Response):
 @app.get("/tickets/{username}")
 async def get_user_tickets(username: str) -> Dict[str, List[Dict[str, int]]]:
     """Get all tickets for a user"""
-    db_manager = DatabaseManager()
     try:
-        await db_manager.init_pool()
         tickets = await db_manager.get_user_tickets(username.lower())
         return {
             "tickets": [
@@ -95,74 +102,27 @@ async def get_user_tickets(username: str) -> Dict[str, List[Dict[str, int]]]:
     except Exception as e:
         logger.error(f"Error getting tickets for {username}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await db_manager.close_pool()
 
 @app.get("/tickets")
-async def get_all_tickets() -> Dict[str, Dict[str, List[int]]]:
+async def get_all_tickets() -> Response:
     """Get all valid tickets for all users"""
-    db_manager = DatabaseManager()
     try:
-        await db_manager.init_pool()
-        # Ensure table exists
-        await db_manager.create_tickets_table()
-        
-        async with db_manager.pool.acquire() as conn:
-            rows = await conn.fetch(f'''
-                SELECT username, ticket_number
-                FROM {db_manager.schema}.{db_manager.table_name}
-                WHERE is_valid = TRUE
-                ORDER BY username, ticket_number
-            ''')
-            
-            tickets_by_user = {}
-            for row in rows:
-                username = row['username']
-                if username not in tickets_by_user:
-                    tickets_by_user[username] = []
-                tickets_by_user[username].append(row['ticket_number'])
-            
-            return {"tickets": tickets_by_user}
+        tickets_json = await db_manager.get_all_tickets_json()
+        return Response(content=tickets_json, media_type="application/json")
     except Exception as e:
         logger.error(f"Error getting all tickets: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await db_manager.close_pool()
 
 @app.post("/tickets/sync")
 async def sync_tickets():
     """Force a sync of all tickets based on current entries"""
-    stats_collector = StatsCollector()
-    db_manager = DatabaseManager()
     try:
-        entries = await stats_collector.calculate_entries()
-        await db_manager.init_pool()
+        entries = await collector.calculate_entries()
         await db_manager.sync_all_tickets(entries)
         return {"status": "success", "message": "Tickets synchronized successfully"}
     except Exception as e:
         logger.error(f"Error syncing tickets: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        await db_manager.close_pool()
-
-@app.on_event("startup")
-async def startup_event():
-    """Initialize database on startup"""
-    db_manager = DatabaseManager()
-    try:
-        await db_manager.init_pool()
-        await db_manager.create_tickets_table()
-    except Exception as e:
-        logger.error(f"Error initializing database: {str(e)}")
-        raise e
-    finally:
-        await db_manager.close_pool()
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup on shutdown"""
-    db_manager = DatabaseManager()
-    await db_manager.close_pool()
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8081, reload=False) 
\ No newline at end of file
@@ -1,12 +1,13 @@
 import asyncio
 import logging
 from datetime import datetime
-from typing import Dict, List, Optional, Set
+from typing import Dict, FrozenSet, Optional
 import aiohttp
+import orjson
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
-from collections import defaultdict
+from collections import Counter, defaultdict
 from db_manager import DatabaseManager
 
 # Configure logging
@@ -20,25 +21,31 @@ logger = logging.getLogger(__name__)
 load_dotenv('.env-local' if os.path.exists('.env-local') else '.env')
 
 class StatsCollector:
-    def __init__(self):
+    def __init__(self, db_manager: Optional[DatabaseManager] = None):
         self.base_url = os.getenv('API_BASE_URL', 'http://localhost:8000')
         self.endpoints = {
             'subscribers': os.getenv('ENDPOINT_SUBSCRIBERS', '/subscribers'),
             'followers': os.getenv('ENDPOINT_FOLLOWERS', '/followers'),
             'gift_subs': os.getenv('ENDPOINT_GIFT_SUBS', '/gift-subs')
         }
-        self.excluded_users: Set[str] = {
+        self.excluded_users: FrozenSet[str] = frozenset(
             username.lower() for username in 
             os.getenv('EXCLUDED_USERS', '').split(',') 
             if username.strip()
-        }
-        self.db_manager = DatabaseManager()
+        )
+        self.db_manager = db_manager or DatabaseManager()
         self.session: Optional[aiohttp.ClientSession] = None
 
     async def init_session(self):
         """Initialize the aiohttp session"""
         if not self.session:
-            connector = aiohttp.TCPConnector(ssl=False)
+            # Keep connections alive so polls reuse them across cycles
+            connector = aiohttp.TCPConnector(
+                ssl=False,
+                limit=100,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            )
             self.session = aiohttp.ClientSession(connector=connector)
 
     async def close_session(self):
@@ -52,7 +59,7 @@ class StatsCollector:
         try:
             async with self.session.get(f"{self.base_url}{endpoint}") as response:
                 if response.status == 200:
-                    return await response.json()
+                    return await response.json(loads=orjson.loads)
                 else:
                     logger.error(f"Error fetching {endpoint}: {response.status}")
                     return {}
@@ -62,66 +69,77 @@ class StatsCollector:
 
     async def calculate_entries(self) -> Dict[str, int]:
         """Calculate entries for each user"""
-        entries: Dict[str, int] = {}
-        
-        # Get followers (1 entry each)
-        followers = await self.fetch_endpoint(self.endpoints['followers'])
-        if followers and 'followers' in followers:
-            for follower in followers['followers']:
-                username = follower['username'].lower()
-                if username not in self.excluded_users:
-                    entries[username] = entries.get(username, 0) + 1
-
-        # Get subscribers (5 entries each)
-        subscribers = await self.fetch_endpoint(self.endpoints['subscribers'])
-        if subscribers and 'subscribers' in subscribers:
-            for subscriber in subscribers['subscribers']:
-                username = subscriber['username'].lower()
-                if username not in self.excluded_users:
-                    entries[username] = entries.get(username, 0) + 5
-
-        # Get gifted subs (5 entries per gifted sub for the gifter)
-        gift_subs = await self.fetch_endpoint(self.endpoints['gift_subs'])
-        if gift_subs and 'gifts' in gift_subs:
-            for gift in gift_subs['gifts']:
-                username = gift['gifter'].lower()
-                if username not in self.excluded_users:
-                    entries[username] = entries.get(username, 0) + (5 * gift['quantity'])
+        # The endpoints are independent, so fetch them concurrently
+        followers, subscribers, gift_subs = await asyncio.gather(
+            self.fetch_endpoint(self.endpoints['followers']),
+            self.fetch_endpoint(self.endpoints['subscribers']),
+            self.fetch_endpoint(self.endpoints['gift_subs'])
+        )
+        excluded = self.excluded_users
+
+        # Followers (1 entry each)
+        entries: Counter = Counter(
+            username
+            for follower in followers.get('followers', ())
+            if (username := follower['username'].lower()) not in excluded
+        )
+
+        # Subscribers (5 entries each)
+        subscribed = Counter(
+            username
+            for subscriber in subscribers.get('subscribers', ())
+            if (username := subscriber['username'].lower()) not in excluded
+        )
+        entries.update({username: 5 * count for username, count in subscribed.items()})
+
+        # Gifted subs (5 entries per gifted sub for the gifter)
+        gifted: Counter = Counter()
+        for gift in gift_subs.get('gifts', ()):
+            if (username := gift['gifter'].lower()) not in excluded:
+                gifted[username] += gift['quantity']
+        entries.update({username: 5 * count for username, count in gifted.items()})
 
         return entries
 
     def log_entries(self, entries: Dict[str, int]):
         """Log the entries list"""
-        logger.info("Giveaway Entries:")
-        for username, count in sorted(entries.items(), key=lambda x: x[1], reverse=True):
-            logger.info(f"{username}: {count}")
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        ranked = sorted(entries.items(), key=lambda x: x[1], reverse=True)
+        logger.info(
+            "Giveaway Entries:\n%s",
+            "\n".join(f"{username}: {count}" for username, count in ranked)
+        )
 
     async def collect_stats(self):
         """Collect and process stats"""
         await self.init_session()
-        try:
-            entries = await self.calculate_entries()
-            self.log_entries(entries)
-            
-            # Sync tickets with the database
-            await self.db_manager.sync_all_tickets(entries)
-        finally:
-            await self.close_session()
+        entries = await self.calculate_entries()
+        self.log_entries(entries)
+        
+        # Sync tickets with the database
+        await self.db_manager.sync_all_tickets(entries)
 
     async def start_polling(self):
         """Start periodic polling of stats"""
         while True:
-            await self.collect_stats()
+            try:
+                await self.collect_stats()
+            except Exception as e:
+                # A failed cycle (e.g. a command timeout) must not end polling
+                logger.error(f"Error collecting stats: {e!r}")
             await asyncio.sleep(int(os.getenv('POLLING_INTERVAL', 30)))
 
 async def main():
     collector = StatsCollector()
     try:
+        await collector.db_manager.init_pool()
         await collector.start_polling()
     except KeyboardInterrupt:
         logger.info("Stats collection stopped by user")
     finally:
         await collector.close_session()
+        await collector.db_manager.close_pool()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file